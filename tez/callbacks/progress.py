@@ -25,10 +25,12 @@ class Progress(Callback):
             raise ValueError(f"Unknown stage: {stage}")
 
     def on_train_step_end(self, tez_trainer, **kwargs):
-        train_metrics = tez_trainer.metrics["train"]
-        if "epoch" in train_metrics:
-            del train_metrics["epoch"]
-        self._train_tqdm.set_postfix(epoch=tez_trainer.current_epoch, **train_metrics)
+        # metrics are only refreshed every `log_steps` batches, no need to redraw the postfix in between
+        if tez_trainer.batch_index % tez_trainer.config.log_steps == 0:
+            train_metrics = tez_trainer.metrics["train"]
+            if "epoch" in train_metrics:
+                del train_metrics["epoch"]
+            self._train_tqdm.set_postfix(epoch=tez_trainer.current_epoch, **train_metrics)
         self._train_tqdm.update(1)
 
     # def on_valid_step_end(self, tez_trainer, **kwargs):
@@ -11,7 +11,8 @@ class AWP:
             adv_eps=0.2,
             adv_step=1,
             scaler=None,
-            device="cuda"
+            device="cuda",
+            amp_dtype=torch.float16
     ):
         self.model = model
         self.optimizer = optimizer
@@ -23,6 +24,7 @@ class AWP:
         self.backup_eps = {}
         self.scaler = scaler
         self.device = device
+        self.amp_dtype = amp_dtype
 
     def attack_backward(self, data):
         self._save()
@@ -30,7 +32,7 @@ class AWP:
             data[key] = value.to(self.device)
         for i in range(self.adv_step):
             self._attack_step()
-            with torch.cuda.amp.autocast():
+            with torch.amp.autocast(device_type=self.device, dtype=self.amp_dtype, enabled=self.amp_dtype is not None):
                 _, adv_loss, _ = self.model(**data)
             self.optimizer.zero_grad()
             self.scaler.scale(adv_loss).backward()
@@ -17,7 +17,11 @@ class TezConfig:
     gradient_accumulation_steps: Optional[int] = 1
     clip_grad_norm: Optional[float] = 10
     num_jobs: Optional[int] = -1
-    fp16: Optional[bool] = True
+    fp16: Optional[bool] = True  # mixed precision, only used when device is cuda
+    amp_dtype: Optional[str] = "float16"  # float16 or bfloat16, used when fp16 is True
+    channels_last: Optional[bool] = False  # use channels_last memory format for 4d weights and inputs (cnns)
+    compile: Optional[bool] = False  # torch.compile the model, works best with fixed input shapes (drop_last, padding)
+    fuse_optim_in_backward: Optional[bool] = False  # step the optimizer per parameter during backward
 
     # data loader parameters
     train_shuffle: Optional[bool] = True
@@ -32,6 +36,9 @@ class TezConfig:
     step_scheduler_after: Optional[str] = "batch"  # "epoch" or "batch"
     step_scheduler_metric: Optional[str] = None
 
+    # logging parameters
+    log_steps: Optional[int] = 10  # sync losses and metrics with the host every n batches
+
     # TODO: validation parameters
     val_strategy: Optional[str] = "batch"  # epoch or batch
     val_steps: Optional[int] = 500  # not used if val_strategy is "epoch"
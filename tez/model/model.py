@@ -2,6 +2,7 @@
 The tez model class
 """
 
+import pickle
 import warnings
 
 import psutil
@@ -121,6 +122,8 @@ class Model(nn.Module):
                 sampler=train_sampler,
                 shuffle=train_shuffle,
                 collate_fn=train_collate_fn,
+                pin_memory=True,
+                persistent_workers=n_jobs > 0,
             )
         if self.valid_loader is None:
             if valid_dataset is not None:
@@ -131,6 +134,8 @@ class Model(nn.Module):
                     sampler=valid_sampler,
                     shuffle=valid_shuffle,
                     collate_fn=valid_collate_fn,
+                    pin_memory=True,
+                    persistent_workers=n_jobs > 0,
                 )
 
         if self.optimizer is None:
@@ -141,7 +146,11 @@ class Model(nn.Module):
 
         self.fp16 = fp16
         if self.fp16:
-            self.scaler = torch.cuda.amp.GradScaler()
+            # torch.amp.GradScaler is only available in pytorch >= 2.3
+            if hasattr(torch.amp, "GradScaler"):
+                self.scaler = torch.amp.GradScaler("cuda")
+            else:
+                self.scaler = torch.cuda.amp.GradScaler()
 
         self._callback_runner = CallbackRunner(callbacks, self)
         self.train_state = enums.TrainingState.TRAIN_START
@@ -163,9 +172,9 @@ class Model(nn.Module):
 
     def model_fn(self, data):
         for key, value in data.items():
-            data[key] = value.to(self.device)
+            data[key] = value.to(self.device, non_blocking=True)
         if self.fp16:
-            with torch.cuda.amp.autocast():
+            with torch.amp.autocast(device_type="xla" if self.using_tpu else "cuda"):
                 output, loss, metrics = self(**data)
         else:
             output, loss, metrics = self(**data)
@@ -173,33 +182,37 @@ class Model(nn.Module):
 
     def train_one_step(self, data):
         if self.accumulation_steps == 1 and self.batch_index == 0:
-            self.zero_grad()
+            self.optimizer.zero_grad(set_to_none=True)
         _, loss, metrics = self.model_fn(data)
         loss = loss / self.accumulation_steps
         if self.fp16:
             self.scaler.scale(loss).backward()
         else:
             loss.backward()
-        if self.clip_grad_norm is not None:
-            torch.nn.utils.clip_grad_norm_(self.parameters(), self.clip_grad_norm)
         if (self.batch_index + 1) % self.accumulation_steps == 0:
+            if self.clip_grad_norm is not None:
+                if self.fp16:
+                    self.scaler.unscale_(self.optimizer)
+                torch.nn.utils.clip_grad_norm_(self.parameters(), self.clip_grad_norm)
+            stepped = True
             if self.fp16:
+                prev_scale = self.scaler.get_scale()
                 self.scaler.step(self.optimizer)
                 self.scaler.update()
+                stepped = self.scaler.get_scale() >= prev_scale
             else:
                 if self.using_tpu:
                     xm.optimizer_step(self.optimizer, barrier=True)
                 else:
                     self.optimizer.step()
-            if self.scheduler:
+            if self.scheduler and stepped:
                 if self.step_scheduler_after == "batch":
                     if self.step_scheduler_metric is None:
                         self.scheduler.step()
                     else:
                         step_metric = self.name_to_metric(self.step_scheduler_metric)
                         self.scheduler.step(step_metric)
-            if self.batch_index > 0:
-                self.zero_grad()
+            self.optimizer.zero_grad(set_to_none=True)
         return loss, metrics
 
     def validate_one_step(self, data):
@@ -219,30 +232,38 @@ class Model(nn.Module):
         self.model_state = enums.ModelState.TRAIN
         losses = AverageMeter()
         if self.accumulation_steps > 1:
-            self.optimizer.zero_grad()
+            self.optimizer.zero_grad(set_to_none=True)
         if self.using_tpu:
             tk0 = data_loader
         else:
             tk0 = tqdm(data_loader, total=len(data_loader))
+        # running loss sum is kept on the device and only synced with the host every 10 batches
+        loss_sum, loss_count = None, 0
         for b_idx, data in enumerate(tk0):
             self.batch_index = b_idx
             self.train_state = enums.TrainingState.TRAIN_STEP_START
             loss, metrics = self.train_one_step(data)
             self.train_state = enums.TrainingState.TRAIN_STEP_END
-            losses.update(loss.item() * self.accumulation_steps, data_loader.batch_size)
+            loss = loss.detach() * self.accumulation_steps * data_loader.batch_size
+            loss_sum = loss if loss_sum is None else loss_sum + loss
+            loss_count += data_loader.batch_size
+            if b_idx % 10 == 0:
+                losses.update((loss_sum / loss_count).item(), loss_count)
+                loss_sum, loss_count = None, 0
             if b_idx == 0:
                 metrics_meter = {k: AverageMeter() for k in metrics}
-            monitor = {}
             for m_m in metrics_meter:
                 metrics_meter[m_m].update(metrics[m_m], data_loader.batch_size)
-                monitor[m_m] = metrics_meter[m_m].avg
             self.current_train_step += 1
-            if not self.using_tpu:
-                tk0.set_postfix(loss=losses.avg, stage="train", **monitor)
+            if not self.using_tpu and b_idx % 10 == 0:
+                tk0.set_postfix(loss=losses.avg, stage="train", **{k: m.avg for k, m in metrics_meter.items()})
             if self.using_tpu:
                 print(f"train step: {self.current_train_step} loss: {losses.avg}")
         if not self.using_tpu:
             tk0.close()
+        if loss_count > 0:
+            losses.update((loss_sum / loss_count).item(), loss_count)
+        monitor = {k: m.avg for k, m in metrics_meter.items()}
         self.update_metrics(losses=losses, monitor=monitor)
 
         return losses.avg
@@ -255,23 +276,30 @@ class Model(nn.Module):
             tk0 = data_loader
         else:
             tk0 = tqdm(data_loader, total=len(data_loader))
-        for b_idx, data in enumerate(tk0):
-            self.train_state = enums.TrainingState.VALID_STEP_START
-            with torch.no_grad():
+        loss_sum, loss_count = None, 0
+        with torch.inference_mode():
+            for b_idx, data in enumerate(tk0):
+                self.train_state = enums.TrainingState.VALID_STEP_START
                 loss, metrics = self.validate_one_step(data)
-            self.train_state = enums.TrainingState.VALID_STEP_END
-            losses.update(loss.item(), data_loader.batch_size)
-            if b_idx == 0:
-                metrics_meter = {k: AverageMeter() for k in metrics}
-            monitor = {}
-            for m_m in metrics_meter:
-                metrics_meter[m_m].update(metrics[m_m], data_loader.batch_size)
-                monitor[m_m] = metrics_meter[m_m].avg
-            if not self.using_tpu:
-                tk0.set_postfix(loss=losses.avg, stage="valid", **monitor)
-            self.current_valid_step += 1
+                self.train_state = enums.TrainingState.VALID_STEP_END
+                loss = loss.detach() * data_loader.batch_size
+                loss_sum = loss if loss_sum is None else loss_sum + loss
+                loss_count += data_loader.batch_size
+                if b_idx % 10 == 0:
+                    losses.update((loss_sum / loss_count).item(), loss_count)
+                    loss_sum, loss_count = None, 0
+                if b_idx == 0:
+                    metrics_meter = {k: AverageMeter() for k in metrics}
+                for m_m in metrics_meter:
+                    metrics_meter[m_m].update(metrics[m_m], data_loader.batch_size)
+                if not self.using_tpu and b_idx % 10 == 0:
+                    tk0.set_postfix(loss=losses.avg, stage="valid", **{k: m.avg for k, m in metrics_meter.items()})
+                self.current_valid_step += 1
         if not self.using_tpu:
             tk0.close()
+        if loss_count > 0:
+            losses.update((loss_sum / loss_count).item(), loss_count)
+        monitor = {k: m.avg for k, m in metrics_meter.items()}
         self.update_metrics(losses=losses, monitor=monitor)
         return losses.avg
 
@@ -301,10 +329,10 @@ class Model(nn.Module):
             tk0 = tqdm(data_loader, total=len(data_loader))
 
         for _, data in enumerate(tk0):
-            with torch.no_grad():
+            with torch.inference_mode():
                 out = self.predict_one_step(data)
                 out = self.process_output(out)
-                yield out
+            yield out
 
             if not self.using_tpu:
                 tk0.set_postfix(stage="test")
@@ -349,7 +377,14 @@ class Model(nn.Module):
         self.device = device
         if next(self.parameters()).device != self.device:
             self.to(self.device)
-        model_dict = torch.load(model_path, map_location=torch.device(device))
+        if weights_only:
+            model_dict = torch.load(model_path, map_location=torch.device(device), weights_only=True)
+        else:
+            try:
+                model_dict = torch.load(model_path, map_location=torch.device(device), weights_only=True)
+            except pickle.UnpicklingError:
+                # fall back to the full unpickler for checkpoints containing arbitrary objects
+                model_dict = torch.load(model_path, map_location=torch.device(device), weights_only=False)
         if weights_only:
             self.load_state_dict(model_dict)
         else:
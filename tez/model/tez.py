@@ -1,7 +1,12 @@
+import contextlib
 import multiprocessing
 import os
+import pickle
+import socket
+import sys
 import time
 import warnings
+from collections import OrderedDict
 
 import torch
 from torch.utils.data import DataLoader
@@ -18,6 +23,56 @@ from .awp import AWP
 
 warnings.filterwarnings("ignore", category=UserWarning)
 
+# full checkpoints store the TezConfig, allow it so they can be loaded with weights_only=True
+if hasattr(torch.serialization, "add_safe_globals"):
+    torch.serialization.add_safe_globals([TezConfig])
+
+
+AMP_DTYPES = {"float16": torch.float16, "bfloat16": torch.bfloat16}
+
+
+def _to_cpu_async(obj):
+    # copy every cuda tensor of a (nested) state dict into pinned host memory without blocking, and wait for all
+    # the copies at once instead of letting torch.save copy each tensor synchronously
+    staged = {}
+
+    def _copy(value):
+        if isinstance(value, torch.Tensor) and value.is_cuda:
+            # tied parameters share their data, stage them once so torch.save still writes a single storage
+            key = (value.data_ptr(), value.dtype, tuple(value.shape), value.stride())
+            if key not in staged:
+                staging = torch.empty(value.shape, dtype=value.dtype, device="cpu", pin_memory=True)
+                staged[key] = staging.copy_(value, non_blocking=True)
+            return staged[key]
+        if isinstance(value, dict):
+            copied = OrderedDict() if isinstance(value, OrderedDict) else {}
+            for k, v in value.items():
+                copied[k] = _copy(v)
+            if hasattr(value, "_metadata"):
+                copied._metadata = value._metadata
+            return copied
+        if type(value) in (list, tuple):
+            return type(value)(_copy(v) for v in value)
+        return value
+
+    obj = _copy(obj)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return obj
+
+
+def _find_free_port():
+    with contextlib.closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return str(sock.getsockname()[1])
+
+
+def _ddp_worker(local_rank, world_size, trainer, train_dataset, valid_dataset, config, kwargs):
+    os.environ["LOCAL_RANK"] = str(local_rank)
+    os.environ["RANK"] = str(local_rank)
+    os.environ["WORLD_SIZE"] = str(world_size)
+    trainer.fit(train_dataset, valid_dataset, config, **kwargs)
+
 
 class Tez:
     def __init__(self, model):
@@ -28,6 +83,9 @@ class Tez:
         self.optimizer = None
         self.scheduler = None
         self.scaler = None
+        self.amp_dtype = None
+        self._use_amp = False
+        self._use_grad_scaler = False
         self.current_epoch = 0
         self.batch_index = 0
         self.current_train_step = 0
@@ -44,32 +102,40 @@ class Tez:
         self.metrics["test"] = {}
         self.num_train_steps = None
         self.num_valid_steps = None
-
-    def _configure_model(self):
+        self._clip_params = None
+        self._fused_optimizers = None
+        self._fused_hook_handles = []
+        self._pending_values = {}
+        self._metric_name_cache = {}
+        self._train_step_impl = None
+
+    def _init_distributed(self):
         local_rank = int(os.environ.get("LOCAL_RANK", -1))
         if local_rank != -1 and local_rank != self.local_rank:
             self.local_rank = local_rank
 
+        if self.local_rank != -1 and self.config.device == "cuda" and not torch.distributed.is_initialized():
+            torch.cuda.set_device(self.local_rank)
+            torch.distributed.init_process_group(backend="nccl")
+            self.world_size = torch.distributed.get_world_size()
+
+    def _configure_model(self):
+        if self.config.channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last)
+
         if self.config.device == "cpu":
             device = torch.device("cpu")
             self.num_gpu = 0
         elif self.config.device == "cuda":
-            if torch.cuda.device_count() > 1:
-                if self.local_rank == -1:
-                    device = torch.device("cuda:0")
-                    self.num_gpu = torch.cuda.device_count()
-                    self.model = torch.nn.DataParallel(self.model, device_ids=list(range(self.num_gpu)))
-                else:
-                    torch.distributed.init_process_group(backend="nccl")
-                    self.world_size = torch.distributed.get_world_size()
-                    device = torch.device("cuda", self.local_rank)
-                    self.model.to(device)
-                    self.model = torch.nn.parallel.DistributedDataParallel(
-                        self.model,
-                        device_ids=[self.local_rank],
-                        output_device=self.local_rank,
-                    )
-                    self.num_gpu = 1
+            if self.local_rank != -1:
+                device = torch.device("cuda", self.local_rank)
+                self.model.to(device)
+                self.model = torch.nn.parallel.DistributedDataParallel(
+                    self.model,
+                    device_ids=[self.local_rank],
+                    output_device=self.local_rank,
+                )
+                self.num_gpu = 1
             else:
                 logger.info("Using single GPU")
                 device = torch.device("cuda:0")
@@ -82,6 +148,7 @@ class Tez:
         self.config = config
         self.train_dataset = train_dataset
         self.valid_dataset = valid_dataset
+        self._init_distributed()
 
         if "train_loader" in kwargs:
             self.train_loader = kwargs["train_loader"]
@@ -134,14 +201,16 @@ class Tez:
             self.train_sampler = DistributedSampler(
                 self.train_dataset,
                 num_replicas=self.world_size,
-                rank=self.local_rank,
+                rank=torch.distributed.get_rank(),
+                shuffle=self.config.train_shuffle,
             )
 
-        if self.world_size > 1 and self.valid_sampler is None:
+        if self.world_size > 1 and self.valid_sampler is None and self.valid_dataset is not None:
             self.valid_sampler = DistributedSampler(
                 self.valid_dataset,
                 num_replicas=self.world_size,
-                rank=self.local_rank,
+                rank=torch.distributed.get_rank(),
+                shuffle=self.config.valid_shuffle,
             )
 
         if self.train_loader is None:
@@ -150,10 +219,12 @@ class Tez:
                 batch_size=self.config.training_batch_size,
                 num_workers=self.config.num_jobs,
                 sampler=self.train_sampler,
-                shuffle=self.config.train_shuffle,
+                # samplers take care of shuffling, DataLoader does not accept both
+                shuffle=self.config.train_shuffle if self.train_sampler is None else False,
                 collate_fn=self.train_collate_fn,
                 drop_last=self.config.train_drop_last,
                 pin_memory=self.config.pin_memory,
+                persistent_workers=self.config.num_jobs > 0,
             )
 
         if self.valid_loader is None:
@@ -163,19 +234,29 @@ class Tez:
                     batch_size=self.config.validation_batch_size,
                     num_workers=self.config.num_jobs,
                     sampler=self.valid_sampler,
-                    shuffle=self.config.valid_shuffle,
+                    shuffle=self.config.valid_shuffle if self.valid_sampler is None else False,
                     collate_fn=self.valid_collate_fn,
                     drop_last=self.config.valid_drop_last,
                     pin_memory=self.config.pin_memory,
+                    persistent_workers=self.config.num_jobs > 0,
                 )
 
         self.optimizer, self.scheduler = self.model.optimizer_scheduler()
 
+        self._init_amp()
         if self.config.fp16:
-            self.scaler = torch.cuda.amp.GradScaler()
+            # torch.amp.GradScaler is only available in pytorch >= 2.3
+            if hasattr(torch.amp, "GradScaler"):
+                self.scaler = torch.amp.GradScaler("cuda", enabled=self._use_grad_scaler)
+            else:
+                self.scaler = torch.cuda.amp.GradScaler(enabled=self._use_grad_scaler)
 
         self._callback_runner = CallbackRunner(self.callbacks, self)
         self._configure_model()
+        if self.config.compile:
+            self.model = torch.compile(self.model, mode="reduce-overhead", fullgraph=False)
+        # needs the parameters on their final device
+        self._use_fused_optimizer()
         self.train_state = enums.TrainingState.TRAIN_START
 
         if self.optimizer is None:
@@ -189,6 +270,7 @@ class Tez:
                            adv_lr=self.config.adv_lr,
                            adv_eps=self.config.adv_eps,
                            scaler=self.scaler,
+                           amp_dtype=self.amp_dtype if self._use_amp else None,
                            device=self.config.device)
             logger.info(f"\nAttack after step {self.config.adv_after_step}")
 
@@ -202,8 +284,95 @@ class Tez:
             if self.scheduler is None:
                 logger.warning("No scheduler found. Continuing without scheduler")
 
+        self._remove_fused_optimizer_hooks()
+        if self.config.fuse_optim_in_backward:
+            if (
+                self.config.gradient_accumulation_steps == 1
+                and not self._use_grad_scaler
+                and self.local_rank == -1
+                and self.config.adv_lr == 0
+            ):
+                self._fuse_optimizer_in_backward()
+                if self.config.clip_grad_norm != -1:
+                    logger.warning("clip_grad_norm is ignored when fuse_optim_in_backward is enabled")
+            else:
+                logger.warning(
+                    "fuse_optim_in_backward requires gradient_accumulation_steps=1, no float16 gradient scaling, "
+                    "adv_lr=0 and no distributed training. Continuing without it"
+                )
+
+        self._clip_params = [p for p in self.model.parameters() if p.requires_grad]
+
+        if self.config.gradient_accumulation_steps == 1:
+            self._train_step_impl = self._train_step_no_accumulation
+        else:
+            self._train_step_impl = self._train_step_accumulation
+
+    def _fuse_optimizer_in_backward(self):
+        self._fused_optimizers = {}
+        for group in self.optimizer.param_groups:
+            defaults = {k: group[k] for k in self.optimizer.defaults if k in group}
+            for param in group["params"]:
+                optimizer = type(self.optimizer)([param], **defaults)
+                # share the state with the original optimizer so that save() still writes the optimizer state
+                optimizer.state = self.optimizer.state
+                self._fused_optimizers[param] = (optimizer, group)
+                self._fused_hook_handles.append(param.register_post_accumulate_grad_hook(self._fused_optimizer_hook))
+
+    def _remove_fused_optimizer_hooks(self):
+        for handle in self._fused_hook_handles:
+            handle.remove()
+        self._fused_hook_handles = []
+        self._fused_optimizers = None
+
+    def _fused_optimizer_hook(self, param):
+        optimizer, group = self._fused_optimizers[param]
+        # the scheduler drives the hyperparameters (lr, betas, momentum, ...) of the original optimizer,
+        # keep the per-parameter copy in sync
+        param_group = optimizer.param_groups[0]
+        for key, value in group.items():
+            if key != "params":
+                param_group[key] = value
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+
+    def _use_fused_optimizer(self):
+        # run the optimizer step as a single multi-tensor cuda kernel instead of one launch per parameter.
+        # the optimizer is updated in place since the scheduler already holds a reference to it.
+        if self.optimizer is None or self.config.device != "cuda" or not torch.cuda.is_available():
+            return
+        if type(self.optimizer) not in (torch.optim.Adam, torch.optim.AdamW, torch.optim.SGD):
+            return
+        if "fused" not in self.optimizer.defaults:
+            # fused implementations are only available in newer versions of pytorch
+            return
+        for group in self.optimizer.param_groups:
+            # respect an explicit choice made in optimizer_scheduler
+            if group.get("fused") is not None or group.get("foreach") is not None:
+                return
+            if group.get("differentiable", False):
+                return
+            # same requirements the optimizer checks when it is built with fused=True
+            if not all(p.is_cuda and torch.is_floating_point(p) for p in group["params"]):
+                return
+        self.optimizer.defaults["fused"] = True
+        for group in self.optimizer.param_groups:
+            group["fused"] = True
+        # fused optimizers unscale and skip inf/nan steps inside the kernel, let GradScaler.step use that path
+        self.optimizer._step_supports_amp_scaling = True
+
+    def _init_amp(self):
+        if self.config.amp_dtype not in AMP_DTYPES:
+            raise ValueError(f"Unknown amp_dtype: {self.config.amp_dtype}. Please use 'float16' or 'bfloat16'")
+        self.amp_dtype = AMP_DTYPES[self.config.amp_dtype]
+        # mixed precision is only used on gpu, fp16 autocast on cpu is much slower than float32
+        self._use_amp = self.config.fp16 and self.config.device == "cuda"
+        # bfloat16 has the same dynamic range as float32, so gradients do not need to be scaled
+        self._use_grad_scaler = self._use_amp and self.amp_dtype == torch.float16
+
     def _init_load_weights(self, config):
         self.config = config
+        self._init_amp()
         if self.config.device == "cpu":
             device = torch.device("cpu")
         elif self.config.device == "cuda":
@@ -214,6 +383,9 @@ class Tez:
         if next(self.model.parameters()).device != device:
             self.model.to(device)
 
+        if self.config.channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last)
+
         return device
 
     @property
@@ -241,8 +413,10 @@ class Tez:
     def name_to_metric(self, metric_name):
         if metric_name == "current_epoch":
             return self.current_epoch
-        v_1 = metric_name.split("_")[0]
-        v_2 = "_".join(metric_name.split("_")[1:])
+        if metric_name not in self._metric_name_cache:
+            v_1, _, v_2 = metric_name.partition("_")
+            self._metric_name_cache[metric_name] = (v_1, v_2)
+        v_1, v_2 = self._metric_name_cache[metric_name]
         return self.metrics[v_1][v_2]
 
     def update_metrics(self, losses, monitor):
@@ -252,17 +426,19 @@ class Tez:
         self.metrics[self._model_state.value]["loss"] = losses.avg
 
     def save(self, model_path, weights_only=False):
-        if self.local_rank != -1 or self.num_gpu > 1:
-            model_state_dict = self.model.module.state_dict()
+        # torch.compile wraps the model, save the state dict of the original module
+        model = getattr(self.model, "_orig_mod", self.model)
+        if self.local_rank != -1:
+            model_state_dict = model.module.state_dict()
         else:
-            model_state_dict = self.model.state_dict()
+            model_state_dict = model.state_dict()
 
         if weights_only:
-            if self.local_rank != -1 and self.num_gpu > 1:
+            if self.local_rank != -1:
                 if torch.distributed.get_rank() == 0:
-                    torch.save(model_state_dict, model_path)
+                    torch.save(_to_cpu_async(model_state_dict), model_path)
             else:
-                torch.save(model_state_dict, model_path)
+                torch.save(_to_cpu_async(model_state_dict), model_path)
             return
 
         if self.optimizer is not None:
@@ -281,11 +457,11 @@ class Tez:
         model_dict["scheduler"] = sch_state_dict
         model_dict["config"] = self.config
 
-        if self.local_rank != -1 and self.num_gpu > 1:
+        if self.local_rank != -1:
             if torch.distributed.get_rank() == 0:
-                torch.save(model_dict, model_path)
+                torch.save(_to_cpu_async(model_dict), model_path)
         else:
-            torch.save(model_dict, model_path)
+            torch.save(_to_cpu_async(model_dict), model_path)
 
     def load(self, model_path, weights_only=False, config: TezConfig = None):
         if config is None:
@@ -293,37 +469,52 @@ class Tez:
 
         device = self._init_load_weights(config)
 
-        model_dict = torch.load(model_path, map_location=device)
         if weights_only:
-            self.model.load_state_dict(model_dict)
+            model_dict = torch.load(model_path, map_location=device, weights_only=True)
         else:
-            self.model.load_state_dict(model_dict["state_dict"])
+            try:
+                model_dict = torch.load(model_path, map_location=device, weights_only=True)
+            except pickle.UnpicklingError:
+                # checkpoints saved with older versions of torch or tez may not load with the restricted unpickler
+                model_dict = torch.load(model_path, map_location=device, weights_only=False)
+
+        # save() writes the state dict of the original module, load it into the same module
+        model = getattr(self.model, "_orig_mod", self.model)
+        if self.local_rank != -1:
+            model = model.module
+        if weights_only:
+            model.load_state_dict(model_dict)
+        else:
+            model.load_state_dict(model_dict["state_dict"])
 
     def model_fn(self, data):
         for key, value in data.items():
-            data[key] = value.to(self.config.device)
-        if self.config.fp16:
-            with torch.cuda.amp.autocast():
+            if self.config.channels_last and value.dim() == 4:
+                data[key] = value.to(self.config.device, non_blocking=True, memory_format=torch.channels_last)
+            else:
+                data[key] = value.to(self.config.device, non_blocking=True)
+        if self._use_amp:
+            with torch.amp.autocast(device_type="cuda", dtype=self.amp_dtype):
                 output, loss, metrics = self.model(**data)
         else:
             output, loss, metrics = self.model(**data)
         return output, loss, metrics
 
-    def _zero_grad(self):
-        if self.config.gradient_accumulation_steps == 1 and self.batch_index == 0:
-            self.model.zero_grad()
-
-    def _backward(self, loss, metrics):
-        if self.num_gpu > 1:
-            loss = loss.mean()
-            for metric in metrics:
-                metrics[metric] = metrics[metric].mean()
+    def _backward(self, loss):
         loss = loss / self.config.gradient_accumulation_steps
 
-        if self.config.fp16:
-            self.scaler.scale(loss).backward()
+        # only the last micro-batch of an accumulation window needs to all-reduce gradients
+        is_accumulating = (self.batch_index + 1) % self.config.gradient_accumulation_steps != 0
+        if self.local_rank != -1 and is_accumulating:
+            sync_context = self.model.no_sync()
         else:
-            loss.backward()
+            sync_context = contextlib.nullcontext()
+
+        with sync_context:
+            if self._use_grad_scaler:
+                self.scaler.scale(loss).backward()
+            else:
+                loss.backward()
 
     def _attack(self, data):
         if (self.config.adv_lr == 0) or (self.current_train_step < self.config.adv_after_step):
@@ -335,43 +526,66 @@ class Tez:
 
     def _clip_grad_norm(self):
         if self.config.clip_grad_norm != -1:
-            torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.config.clip_grad_norm)
+            if self._use_grad_scaler:
+                self.scaler.unscale_(self.optimizer)
+            torch.nn.utils.clip_grad_norm_(self._clip_params, self.config.clip_grad_norm)
+
+    def _optimizer_step(self):
+        if self._fused_optimizers is not None:
+            # parameters have already been updated by the hooks during backward
+            return True
+        self._clip_grad_norm()
+        if self._use_grad_scaler:
+            prev_scale = self.scaler.get_scale()
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+            # the scaler skips the optimizer step and lowers the scale when gradients contain inf/nan
+            return self.scaler.get_scale() >= prev_scale
+        self.optimizer.step()
+        return True
+
+    def _update(self):
+        stepped = self._optimizer_step()
+
+        if self.scheduler is not None and stepped:
+            if self.config.step_scheduler_after == "batch":
+                if self.config.step_scheduler_metric is None:
+                    self.scheduler.step()
+                else:
+                    step_metric = self.name_to_metric(self.config.step_scheduler_metric)
+                    self.scheduler.step(step_metric)
+
+        self.optimizer.zero_grad(set_to_none=True)
 
     def _step(self):
         is_bi_mod_acc_zero = (self.batch_index + 1) % self.config.gradient_accumulation_steps == 0
         is_bi_end = self.batch_index + 1 == self.train_loader
         if is_bi_mod_acc_zero or is_bi_end:
-            if self.config.fp16:
-                self.scaler.step(self.optimizer)
-                self.scaler.update()
-            else:
-                self.optimizer.step()
-
-            if self.scheduler is not None:
-                if self.config.step_scheduler_after == "batch":
-                    if self.config.step_scheduler_metric is None:
-                        self.scheduler.step()
-                    else:
-                        step_metric = self.name_to_metric(self.config.step_scheduler_metric)
-                        self.scheduler.step(step_metric)
+            self._update()
 
-            self.model.zero_grad()
-
-    def train_step(self, data):
-        self._zero_grad()
+    def _train_step_accumulation(self, data):
         _, loss, metrics = self.model_fn(data)
-        self._backward(loss, metrics)
+        self._backward(loss)
         self._attack(data)
-        self._clip_grad_norm()
         self._step()
         return loss, metrics
 
+    def _train_step_no_accumulation(self, data):
+        # every batch is an optimizer step: no loss division by accumulation steps, no no_sync and no boundary checks
+        _, loss, metrics = self.model_fn(data)
+        if self._use_grad_scaler:
+            self.scaler.scale(loss).backward()
+        else:
+            loss.backward()
+        self._attack(data)
+        self._update()
+        return loss, metrics
+
+    def train_step(self, data):
+        return self._train_step_impl(data)
+
     def predict_step(self, data):
         _, loss, metrics = self.model_fn(data)
-        if self.num_gpu > 1:
-            loss = loss.mean()
-            for metric in metrics:
-                metrics[metric] = metrics[metric].mean()
         return loss, metrics
 
     def _set_training_epoch_start(self, data_loader):
@@ -381,31 +595,59 @@ class Tez:
         self.model_state = enums.ModelState.TRAIN
         self.train_state = enums.TrainingState.TRAIN_EPOCH_START
         self.model.train()
-        if self.config.gradient_accumulation_steps > 1:
-            self.optimizer.zero_grad()
+        self.optimizer.zero_grad(set_to_none=True)
+
+    def _accumulate_loss_metrics(self, losses, loss, metrics, batch_size):
+        # keep running sums of the loss and metrics on the device and only sync with the host every
+        # `log_steps` batches
+        # metrics may be returned with any shape (e.g. torch.tensor([acc])), reduce everything to a scalar first
+        values = [loss.detach().float().reshape(-1).mean()]
+        values += [metrics[k].detach().float().reshape(-1).mean().to(loss.device) for k in self.metrics_meter]
+        values = torch.stack(values)
+        if self.batch_index == 0 or self.model_state.value not in self._pending_values:
+            self._pending_values[self.model_state.value] = [torch.zeros_like(values), 0]
+        pending = self._pending_values[self.model_state.value]
+        pending[0].add_(values * batch_size)
+        pending[1] += batch_size
+        if self.batch_index % self.config.log_steps == 0:
+            self._flush_loss_metrics(losses)
+
+    def _flush_loss_metrics(self, losses):
+        pending = self._pending_values.get(self.model_state.value)
+        if pending is None:
+            return
+        value_sum = pending[0]
+        if self.local_rank != -1 and self.model_state == enums.ModelState.VALID:
+            # a single all-reduce per flush gives every rank the validation values averaged over all ranks
+            value_sum = value_sum.clone()
+            torch.distributed.all_reduce(value_sum, op=torch.distributed.ReduceOp.AVG)
+        values = (value_sum / pending[1]).tolist()
+        losses.update(values[0], pending[1])
+        for m_m, value in zip(self.metrics_meter, values[1:]):
+            self.metrics_meter[m_m].update(value, pending[1])
+        # drop the buffer instead of zeroing it in place, it may be an inference tensor
+        del self._pending_values[self.model_state.value]
 
     def _update_loss_metrics(self, losses, loss, metrics, data_loader):
-        if self.model_state == enums.ModelState.TRAIN:
-            losses.update(loss.item() * self.config.gradient_accumulation_steps, data_loader.batch_size)
-        else:
-            losses.update(loss.item(), data_loader.batch_size)
-
         if self.batch_index == 0:
             self.metrics_meter = {k: AverageMeter() for k in metrics}
 
-        monitor = {}
-        for m_m in self.metrics_meter:
-            self.metrics_meter[m_m].update(metrics[m_m].cpu().detach().numpy(), data_loader.batch_size)
-            monitor[m_m] = self.metrics_meter[m_m].avg
+        self._accumulate_loss_metrics(losses, loss, metrics, data_loader.batch_size)
+
         if self.model_state == enums.ModelState.TRAIN:
             self.current_train_step += 1
         else:
             self.current_valid_step += 1
-        self.update_metrics(losses=losses, monitor=monitor)
-        return losses, monitor
+        if self.batch_index % self.config.log_steps == 0:
+            self.update_metrics(losses=losses, monitor=self._monitor())
+        return losses
 
-    def _set_training_epoch_end(self, losses, monitor):
-        self.update_metrics(losses=losses, monitor=monitor)
+    def _monitor(self):
+        return {k: m.avg for k, m in self.metrics_meter.items()}
+
+    def _set_training_epoch_end(self, losses):
+        self._flush_loss_metrics(losses)
+        self.update_metrics(losses=losses, monitor=self._monitor())
         self.train_state = enums.TrainingState.TRAIN_EPOCH_END
 
     def _set_training_state(self):
@@ -419,7 +661,7 @@ class Tez:
             self.batch_index = batch_index
             self.train_state = enums.TrainingState.TRAIN_STEP_START
             loss, metrics = self.train_step(data)
-            losses, monitor = self._update_loss_metrics(losses, loss, metrics, data_loader)
+            losses = self._update_loss_metrics(losses, loss, metrics, data_loader)
             self.train_state = enums.TrainingState.TRAIN_STEP_END
             if self.valid_loader and self.config.val_strategy == "batch":
                 if (
@@ -429,7 +671,7 @@ class Tez:
                     self.validate(self.valid_loader)
             if self._model_state.value == "end":
                 break
-        self._set_training_epoch_end(losses, monitor)
+        self._set_training_epoch_end(losses)
 
     def _set_validation_epoch_start(self, data_loader):
         if isinstance(data_loader, DataLoader) and isinstance(data_loader.sampler, DistributedSampler):
@@ -439,25 +681,63 @@ class Tez:
         self.model_state = enums.ModelState.VALID
         self.model.eval()
 
-    def _set_validation_epoch_end(self, losses, monitor):
-        self.update_metrics(losses=losses, monitor=monitor)
+    def _set_validation_epoch_end(self, losses):
+        self._flush_loss_metrics(losses)
+        self.update_metrics(losses=losses, monitor=self._monitor())
         self.train_state = enums.TrainingState.VALID_EPOCH_END
 
     def validate(self, data_loader):
         self._set_validation_epoch_start(data_loader)
         losses = AverageMeter()
 
-        for batch_index, data in enumerate(data_loader):
-            self.batch_index = batch_index
-            self.train_state = enums.TrainingState.VALID_STEP_START
-            with torch.no_grad():
+        with torch.inference_mode():
+            for batch_index, data in enumerate(data_loader):
+                self.batch_index = batch_index
+                self.train_state = enums.TrainingState.VALID_STEP_START
                 loss, metrics = self.predict_step(data)
-            losses, monitor = self._update_loss_metrics(losses, loss, metrics, data_loader)
-            self.train_state = enums.TrainingState.VALID_STEP_END
-        self._set_validation_epoch_end(losses, monitor)
+                losses = self._update_loss_metrics(losses, loss, metrics, data_loader)
+                self.train_state = enums.TrainingState.VALID_STEP_END
+        self._set_validation_epoch_end(losses)
+        self._sync_model_state()
         if self.config.val_strategy == "batch" and self._model_state.value != "end":
             self._set_training_state()
 
+    def _sync_model_state(self):
+        # callbacks only run on rank 0, share its decision to stop so that all ranks leave the training loop together
+        if self.local_rank == -1:
+            return
+        stop = int(self._model_state == enums.ModelState.END)
+        stop = torch.tensor(stop, device=torch.device("cuda", self.local_rank))
+        torch.distributed.broadcast(stop, src=0)
+        if stop.item() == 1:
+            self.model_state = enums.ModelState.END
+
+    def _check_spawn_args(self, **objects):
+        # spawned processes re-import __main__ from its file, objects defined in an interactive session
+        # (notebook, REPL) pickle fine here but cannot be unpickled in the workers
+        interactive = not hasattr(sys.modules["__main__"], "__file__")
+        if interactive and type(self.model).__module__ == "__main__":
+            raise RuntimeError(
+                "Multi-GPU training spawns one process per GPU, the model is defined in an interactive session "
+                "and cannot be loaded by the spawned processes. Please move it to a module or run the script "
+                "with torchrun"
+            )
+        for name, obj in objects.items():
+            values = obj if type(obj) in (list, tuple) else [obj]
+            if interactive and any(getattr(value, "__module__", None) == "__main__" for value in values):
+                raise RuntimeError(
+                    f"Multi-GPU training spawns one process per GPU, {name} is defined in an interactive session "
+                    "and cannot be loaded by the spawned processes. Please move it to a module or run the script "
+                    "with torchrun"
+                )
+            try:
+                pickle.dumps(obj)
+            except Exception as e:
+                raise RuntimeError(
+                    f"Multi-GPU training spawns one process per GPU, which requires {name} to be picklable. "
+                    "Please make it picklable or launch the script with torchrun"
+                ) from e
+
     def _step_scheduler_after_epoch(self):
         if self.scheduler is not None:
             if self.config.step_scheduler_after == "epoch":
@@ -470,6 +750,32 @@ class Tez:
     def fit(self, train_dataset, valid_dataset=None, config: TezConfig = None, **kwargs):
         if config is None:
             config = TezConfig()
+
+        num_gpu = torch.cuda.device_count() if config.device == "cuda" else 0
+        if num_gpu > 1 and int(os.environ.get("LOCAL_RANK", -1)) == -1:
+            logger.warning(
+                f"Found {num_gpu} GPUs. DataParallel is no longer used, spawning {num_gpu} DistributedDataParallel "
+                "processes instead. The model, datasets, collate functions and callbacks must be picklable and the "
+                "model in this process is not updated, save it from a callback (e.g. EarlyStopping) or launch "
+                "with torchrun"
+            )
+            self._check_spawn_args(
+                trainer=self,
+                train_dataset=train_dataset,
+                valid_dataset=valid_dataset,
+                config=config,
+                **kwargs,
+            )
+            os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+            if "MASTER_PORT" not in os.environ:
+                os.environ["MASTER_PORT"] = _find_free_port()
+            torch.multiprocessing.spawn(
+                _ddp_worker,
+                args=(num_gpu, self, train_dataset, valid_dataset, config, kwargs),
+                nprocs=num_gpu,
+            )
+            return
+
         self._init_trainer(train_dataset, valid_dataset, config, **kwargs)
 
         losses = AverageMeter()
@@ -480,6 +786,7 @@ class Tez:
                 self.validate(self.valid_loader)
             self._step_scheduler_after_epoch()
             self.train_state = enums.TrainingState.EPOCH_END
+            self._sync_model_state()
             if self._model_state.value == "end":
                 time.sleep(2)
                 break
@@ -540,8 +847,36 @@ class Tez:
         if self.model.training:
             self.model.eval()
 
-        for data in data_loader:
-            with torch.no_grad():
+        # cuda outputs are copied into two pinned host buffers in turn, so that the copy of one batch
+        # overlaps with the forward pass of the next one
+        host_buffers = [None, None]
+        copy_events = [None, None]
+        pending = None
+        for batch_index, data in enumerate(data_loader):
+            with torch.inference_mode():
                 out, _, _ = self.model_fn(data)
-                out = self.process_output(out)
+                if isinstance(out, torch.Tensor) and out.is_cuda:
+                    slot = batch_index % 2
+                    buffer = host_buffers[slot]
+                    if buffer is None or buffer.shape != out.shape or buffer.dtype != out.dtype:
+                        host_buffers[slot] = torch.empty(out.shape, dtype=out.dtype, device="cpu", pin_memory=True)
+                        copy_events[slot] = torch.cuda.Event()
+                    host_buffers[slot].copy_(out, non_blocking=True)
+                    copy_events[slot].record()
+                else:
+                    slot = None
+                    out = self.process_output(out)
+
+            if pending is not None:
+                copy_events[pending].synchronize()
+                yield self.process_output(host_buffers[pending].clone())
+                pending = None
+
+            if slot is None:
                 yield out
+            else:
+                pending = slot
+
+        if pending is not None:
+            copy_events[pending].synchronize()
+            yield self.process_output(host_buffers[pending].clone())